@@ -1,19 +1,28 @@
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from datetime import datetime, timedelta
+from functools import lru_cache
+from hashlib import sha256
+from io import BytesIO
 from pathlib import Path
-from subprocess import Popen, PIPE
+import re
+from socket import timeout as SocketTimeout
+from string import Template as StringTemplate
+from subprocess import CalledProcessError, DEVNULL, Popen, PIPE
 from sys import exit, stderr
-from time import sleep
-from typing import IO, Generator
+from time import sleep, time
+from typing import IO, Generator, Optional
 
 
 from click import command, option
+from httpx import Client, Limits, Timeout
 from llm import (
     get_default_model, get_key, get_model, hookimpl, Attachment, Template
 )
 from mpd import MPDClient # type: ignore
-from mpd.base import CommandError # type: ignore
+from mpd.base import CommandError, ConnectionError as MPDConnectionError # type: ignore
 from openai import OpenAI
+from PIL import Image
 
 
 @hookimpl
@@ -78,7 +87,10 @@ Next: $input
 @option('--tts-api-key',
     help="API key to use for Text-to-speech"
 )
-@option('--audio-format', default='flac', show_default=True)
+@option('--tts-gain', type=float,
+    help="Fixed gain in dB applied to speech instead of dynamic normalization"
+)
+@option('--audio-format', default='opus', show_default=True)
 @option('--mpd-socket', default='/run/mpd/socket', show_default=True)
 @option('--clips-directory', required=True,
     help="Directory relative to MPD music directory to store speech clips in"
@@ -86,11 +98,14 @@ Next: $input
 @option('-a', '--always', is_flag=True,
     help="Announce every song, not just those with album art"
 )
+@option('--clip-ttl', type=int, default=0, show_default=True,
+    help="Reuse the clip of an identical transition for this many days"
+)
 def mpd_cmd(*,
     template, param, tools, model,
-    tts_model, tts_voice, tts_api_key, audio_format,
+    tts_model, tts_voice, tts_api_key, tts_gain, audio_format,
     mpd_socket, clips_directory,
-    always
+    always, clip_ttl
 ):
     """A moderator for Music Player Daemon."""
 
@@ -99,7 +114,7 @@ def mpd_cmd(*,
     mpd = MPDClient()
     try:
         mpd.connect(mpd_socket)
-    except FileNotFoundError:
+    except (FileNotFoundError, ConnectionRefusedError):
         print("Unable to connect to MPD socket, is MPD running?", file=stderr)
         exit(1)
 
@@ -117,8 +132,16 @@ def mpd_cmd(*,
         print(f"{music_directory / clips_directory} is not a directory.", file=stderr)
         exit(3)
 
+    clips_prefix = f'{clips_directory.as_posix()}/'
+
     from llm.cli import load_template
     template = load_template(template)
+    evaluate = compile_template(template, dict(param))
+    try:
+        evaluate({}, date=datetime.now(), prev={})
+    except KeyError as missing:
+        print(f"Template variable {missing} is not set, use --param", file=stderr)
+        exit(4)
 
     tools = _gather_tools(tools, [])
 
@@ -130,133 +153,422 @@ def mpd_cmd(*,
         exit(2)
     conversation = model.conversation(tools=tools)
 
-    openai = OpenAI(api_key=get_key(tts_api_key, 'openai', 'OPENAI_API_KEY'))
+    openai = OpenAI(api_key=get_key(tts_api_key, 'openai', 'OPENAI_API_KEY'),
+        http_client=Client(http2=True,
+            timeout=Timeout(60.0),
+            limits=Limits(max_keepalive_connections=4, keepalive_expiry=300)
+        )
+    )
+
+    executor = ThreadPoolExecutor(max_workers=1)
+    pending = {}
 
     while True:
-        status = mpd.status()
-        if remaining := rolling_and_enough_time(status, 120):
-            prev = mpd.currentsong()
-            nextsongid = status["nextsongid"]
-            next = mpd.playlistid(nextsongid)[0]
-            del_internal_tags((prev, next))
-
-            if none_from_us((prev, next), clips_directory):
-                date = datetime.now() + timedelta(seconds=remaining)
-                padding = int(status.get("xfade", "0"))
-                padding -= padding // 5
-                attachments = get_attachments(mpd, next['file'])
-
-                if always or attachments:
-                    prompt, system = template.evaluate(next,
-                        {'date': date, 'prev': prev, **dict(param)}
+        for songid, future in list(pending.items()):
+            if future.done():
+                del pending[songid]
+                if not future.cancelled() and future.exception():
+                    print(f"Announcing song {songid} failed: {future.exception()!r}",
+                        file=stderr
                     )
-                    if len(conversation.responses) > 20:
-                        conversation = model.conversation(tools=tools)
-                    announcement = conversation.chain(prompt,
-                        system=system,
-                        attachments=attachments,
-                        tools=tools,
-                        stream=False
-                    ).text()
-
-                    filename = music_directory / clips_directory / f'{date.strftime("%Y%m%dT%H%M%S")}.{audio_format}'
-                    with openai.audio.speech.with_streaming_response.create(
-                        input=announcement,
-                        model=tts_model,
-                        voice=tts_voice,
-                        response_format=audio_format
-                    ) as response:
-                        with adjust_and_stream_to_file(
-                            fmt=audio_format, padding=padding,
-                            filename=filename
-                        ) as pipe:
-                            for chunk in response.iter_bytes(4096):
-                                pipe.write(chunk)
 
+        try:
+            mpd.command_list_ok_begin()
+            mpd.status()
+            mpd.currentsong()
+            status, prev = mpd.command_list_end()
+
+            # Nobody will hear announcements of songs no longer up next.
+            for songid, future in pending.items():
+                if songid != status.get("nextsongid"):
+                    future.cancel()
+
+            remaining = rolling_and_enough_time(status, 120)
+            if remaining and status["nextsongid"] not in pending:
+                nextsongid = status["nextsongid"]
+                next = mpd.playlistid(nextsongid)[0]
+                del_internal_tags((prev, next))
+
+                if none_from_us((prev, next), clips_prefix):
+                    date = datetime.now() + timedelta(seconds=remaining)
+                    padding = int(status.get("xfade", "0"))
+                    padding -= padding // 5
+                    filename = music_directory / clips_directory / f'{clip_key(prev, next, template, param, tts_model, tts_voice, tts_gain, padding)}.{audio_format}'
                     clip = filename.relative_to(music_directory)
-                    job = mpd.update(str(clip))
-                    while mpd.status().get("updating_db") == job:
-                        sleep(1)
 
-                    if nextsongid == mpd.status().get('nextsongid'):
-                        insert(mpd, str(clip))
+                    if is_fresh(filename, clip_ttl):
+                        pending[nextsongid] = executor.submit(present_clip,
+                            mpd_socket, clip, nextsongid, reused=True
+                        )
+                    else:
+                        prompt, system = evaluate(next, date=date, prev=prev)
+                        pending[nextsongid] = executor.submit(announce,
+                            conversation, prompt,
+                            system=system, file=next['file'], always=always,
+                            tools=tools,
+                            openai=openai, tts_model=tts_model,
+                            tts_voice=tts_voice, audio_format=audio_format,
+                            gain=tts_gain, padding=padding,
+                            filename=filename,
+                            mpd_socket=mpd_socket, clip=clip,
+                            nextsongid=nextsongid
+                        )
+
+            mpd.idle('player')
+
+        except (ConnectionError, MPDConnectionError):
+            reconnect(mpd, mpd_socket)
+
+
+def compile_template(template, params):
+    """Specialize *template* for repeated evaluation with fixed *params*.
+
+    Equivalent to ``template.evaluate(input, {**variables, **params})``,
+    but parses the prompt and system templates only once.
+    """
+
+    prompt = StringTemplate(template.prompt) if template.prompt else None
+    system = StringTemplate(template.system) if template.system else None
+    defaults = template.defaults or {}
+
+    def evaluate(input, **variables):
+        values = {**defaults, **variables, **params, 'input': input}
+        return (
+            prompt.substitute(values) if prompt else str(input),
+            system.substitute(values) if system else None
+        )
 
-        mpd.idle('player')
+    return evaluate
 
 
-def del_internal_tags(songs):
-    for key in ('duration', 'format', 'id', 'last-modified', 'pos', 'prio', 'time'):
-        for song in songs:
-            if key in song:
-                del song[key]
+def announce(conversation, prompt, *,
+    system, file, always, tools,
+    openai, tts_model, tts_voice, audio_format, gain, padding, filename,
+    mpd_socket, clip, nextsongid
+):
+    """Produce a clip in the background and queue it if still relevant."""
+
+    with connection(mpd_socket) as mpd:
+        if mpd.status().get('nextsongid') != nextsongid:
+            return
+
+    attachments = get_attachments(mpd_socket, file)
+    if not (always or attachments):
+        return
+
+    produce_clip(conversation, prompt,
+        system=system, attachments=attachments, tools=tools,
+        openai=openai, tts_model=tts_model, tts_voice=tts_voice,
+        audio_format=audio_format, gain=gain, padding=padding,
+        filename=filename
+    )
+    present_clip(mpd_socket, clip, nextsongid)
+
+
+def present_clip(mpd_socket, clip, nextsongid, reused=False):
+    with connection(mpd_socket, timeout=30) as mpd:
+        # A reused clip has been scanned when it was written, unless the
+        # database was rebuilt since.  Skip the update if MPD knows it.
+        if reused and mpd.find('file', str(clip)):
+            job = None
+        else:
+            job = mpd.update(str(clip))
+
+        # Give up as soon as the song we announce is no longer next.
+        try:
+            while (status := mpd.status()).get('nextsongid') == nextsongid:
+                if status.get('updating_db') != job:
+                    insert(mpd, str(clip), status)
+                    break
+                mpd.idle('update', 'playlist', 'player')
+        except SocketTimeout:
+            print(f"Gave up waiting for MPD to scan {clip}", file=stderr)
+
+
+def produce_clip(conversation, prompt, *,
+    system, attachments, tools,
+    openai, tts_model, tts_voice, audio_format, gain, padding, filename
+) -> Path:
+    if len(conversation.responses) > 20:
+        trim_history(conversation.responses, 10)
+    announcement = conversation.chain(prompt,
+        system=system,
+        attachments=attachments,
+        tools=tools,
+        stream=True
+    )
+
+    # Write to a hidden name MPD does not scan, and only publish the clip
+    # once it is complete.
+    partial = filename.with_name(f'.{filename.name}')
+    try:
+        if padding or gain is not None or audio_format not in TTS_FORMATS:
+            # The chain only sends its request once iterated, so ffmpeg
+            # starts up while we wait for the first tokens.
+            with adjust_and_stream_to_file(
+                fmt=audio_format, gain=gain, padding=padding,
+                filename=partial
+            ) as pipe:
+                # Speak each sentence as soon as the model has finished it.
+                # Raw PCM segments can simply be concatenated.
+                for sentence in sentences(announcement):
+                    speak(openai, sentence,
+                        model=tts_model, voice=tts_voice,
+                        response_format='pcm', output=pipe
+                    )
+        else:
+            # Nothing to pad or amplify, so TTS can encode the clip itself.
+            with open(partial, 'wb') as output:
+                speak(openai, ''.join(announcement),
+                    model=tts_model, voice=tts_voice,
+                    response_format=audio_format, output=output
+                )
+
+        partial.replace(filename)
+    except BaseException:
+        partial.unlink(missing_ok=True)
+        raise
+
+    return filename
+
+
+# Formats the OpenAI speech endpoint can deliver ready to play.
+TTS_FORMATS = frozenset(('aac', 'flac', 'mp3', 'opus', 'wav'))
+
+
+def speak(openai, text, *, model, voice, response_format, output):
+    with openai.audio.speech.with_streaming_response.create(
+        input=text,
+        model=model,
+        voice=voice,
+        response_format=response_format
+    ) as response:
+        for chunk in response.iter_bytes(65536):
+            output.write(chunk)
+
+
+@contextmanager
+def connection(mpd_socket, timeout=None) -> Generator[MPDClient, None, None]:
+    mpd = MPDClient()
+    mpd.timeout = mpd.idletimeout = timeout
+    mpd.connect(mpd_socket)
+    try:
+        yield mpd
+    finally:
+        mpd.disconnect()
+
+
+def reconnect(mpd, mpd_socket, max_delay=60):
+    """Reconnect *mpd*, waiting for MPD to come back if it restarts."""
+
+    mpd.disconnect()
+    delay = 1
+    while True:
+        try:
+            mpd.connect(mpd_socket)
+            return
+        except (OSError, MPDConnectionError):
+            sleep(delay)
+            delay = min(delay * 2, max_delay)
+
+
+SENTENCE_END = re.compile(r'[.!?]\s+')
+
+# A period after a number (ordinals, dates) or a short abbreviation
+# like "z. B." or "Nr." does not end a sentence.
+NO_SENTENCE_END = re.compile(r'(?:\b\d+|\b\w{1,2}|\w\.\w+)\.$')
+
+
+def sentences(chunks, min_length=80):
+    """Yield whole sentences from a stream of text chunks.
+
+    Short sentences are joined until a segment has at least *min_length*
+    characters, so that each speech request has enough context for a
+    natural intonation.
+    """
+
+    text = ''
+    for chunk in chunks:
+        text += chunk
+        while end := sentence_end(text, min_length):
+            yield text[:end].strip()
+            text = text[end:]
+
+    if text.strip():
+        yield text.strip()
 
 
-def none_from_us(songs, clips_directory):
+def sentence_end(text, min_length):
+    for match in SENTENCE_END.finditer(text, max(min_length - 1, 0)):
+        if not NO_SENTENCE_END.search(text[:match.start() + 1]):
+            return match.end()
+
+    return None
+
+
+def trim_history(responses, keep):
+    """Drop the middle of a conversation, keeping its first exchange.
+
+    The first exchange carries the system prompt, so keeping it preserves
+    the prefix providers cache between calls.  Cuts never separate tool
+    calls from the responses carrying their results.
+    """
+
+    def exchange_start(index):
+        while index < len(responses) and responses[index].prompt.tool_results:
+            index += 1
+        return index
+
+    head = exchange_start(1)
+    del responses[head:exchange_start(max(head, len(responses) - keep))]
+
+
+INTERNAL_TAGS = frozenset((
+    'duration', 'format', 'id', 'last-modified', 'pos', 'prio', 'time'
+))
+
+
+def del_internal_tags(songs):
     for song in songs:
-        if clips_directory in Path(song['file']).parents:
-            return False
+        for key in INTERNAL_TAGS.intersection(song):
+            del song[key]
+
+
+def clip_key(prev, next, template, params, *settings) -> str:
+    """Identify a transition, so that its clip can be found again.
+
+    *settings* are everything else that changes how the clip sounds,
+    like voice or padding.
+    """
 
-    return True
+    key = '|'.join((prev['file'], next['file'], template.name or '',
+        *(f'{name}={value}' for name, value in sorted(params)),
+        *map(str, settings)
+    ))
+    return sha256(key.encode()).hexdigest()
+
+
+def is_fresh(filename: Path, days: int) -> bool:
+    try:
+        return time() - filename.stat().st_mtime < days * 86400
+    except FileNotFoundError:
+        return False
+
+
+def none_from_us(songs, clips_prefix):
+    return not any(song['file'].startswith(clips_prefix) for song in songs)
 
 
 def rolling_and_enough_time(status, seconds):
-    if "updating_db" not in status and status["state"] == "play":
+    if (status.get("state") != "play" or "updating_db" in status
+        or "nextsongid" not in status
+    ):
+        return None
+
+    try:
         remaining = float(status["duration"]) - float(status["elapsed"])
-        if remaining >= seconds and "nextsongid" in status:
-            return remaining
+    except (KeyError, ValueError):
+        return None
+
+    return remaining if remaining >= seconds else None
+
+
+# OpenAI delivers raw PCM as 24 kHz 16-bit little-endian mono.
+PCM_INPUT = ('-f', 's16le', '-ar', '24000', '-ac', '1')
+
+ENCODER_OPTIONS = {
+    'opus': (
+        '-c:a', 'libopus', '-b:a', '64k',
+        '-application', 'voip', '-frame_duration', '20'
+    )
+}
 
 
 @contextmanager
 def adjust_and_stream_to_file(
-    fmt: str, padding: int, filename: Path
+    fmt: str, gain: Optional[float], padding: int, filename: Path
 ) -> Generator[IO[bytes], None, None]:
+    # A fixed gain suits TTS voices with a known, stable level and
+    # needs no analysis at all.
+    if gain is None:
+        normalize = 'dynaudnorm=f=250:g=15:p=0.95'
+    else:
+        normalize = f'volume={gain}dB'
+
     ffmpeg = ['ffmpeg',
-        '-loglevel', 'error',
-        '-f', fmt,
+        '-loglevel', 'error', '-y',
+        '-probesize', '32', '-analyzeduration', '0',
+        '-fflags', 'nobuffer', '-flags', 'low_delay', '-max_delay', '0',
+        '-thread_queue_size', '512',
+        *PCM_INPUT,
         '-i', 'pipe:0',
         '-filter_complex', ';'.join((
-            '[0]loudnorm=I=-16:LRA=11:TP=-1[s0]',
+            f'[0]{normalize}[s0]',
             f"[s0]adelay={padding}s:all=True[s1]",
             f"[s1]apad=pad_dur={padding}[s2]"
         )),
         '-map', '[s2]',
+        *ENCODER_OPTIONS.get(fmt, ()),
         str(filename)
     ]
-    proc = Popen(ffmpeg, stdin=PIPE)
+    proc = Popen(ffmpeg, stdin=PIPE, stdout=DEVNULL)
 
     try:
         if proc.stdin is not None:
             with proc.stdin as pipe:
                 yield pipe
 
-            proc.wait()
+            if proc.wait() != 0:
+                raise CalledProcessError(proc.returncode, ffmpeg)
 
     finally:
         if proc.poll() is None:
-            proc.kill() 
+            proc.kill()
 
 
-def get_attachments(mpd, file) -> list[Attachment]:
-    attachments = []
+def get_attachments(mpd_socket, file) -> list[Attachment]:
+    """Fetch album art and embedded picture of *file* concurrently.
+
+    Binary responses can not be part of a command list, so each picture
+    is read over its own connection.
+    """
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        albumart = executor.submit(read_binary, mpd_socket, 'albumart', file)
+        picture = executor.submit(read_binary, mpd_socket, 'readpicture', file)
+        pictures = (albumart.result(), picture.result())
+
+    return [Attachment(content=shrink(data)) for data in pictures if data]
 
-    try:
-        attachments.append(Attachment(content=mpd.albumart(file)["binary"]))
-    except CommandError:
-        pass
+
+@lru_cache(maxsize=4)
+def shrink(data: bytes) -> bytes:
+    """Downscale cover art to the resolution vision models work with.
+
+    Consecutive tracks of an album usually share their cover, hence the cache.
+    """
 
     try:
-        picture = mpd.readpicture(file)
-        if picture:
-            attachments.append(Attachment(content=picture["binary"]))
-    except CommandError:
-        pass
+        with Image.open(BytesIO(data)) as image:
+            image.thumbnail((768, 768), Image.LANCZOS)
+            output = BytesIO()
+            image.convert('RGB').save(output, 'JPEG', quality=85, optimize=True)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return data
+
+    return min(data, output.getvalue(), key=len)
+
 
-    return attachments
+def read_binary(mpd_socket, command, file):
+    with connection(mpd_socket) as mpd:
+        try:
+            return getattr(mpd, command)(file).get("binary")
+        except CommandError:
+            return None
 
 
-def insert(mpd, file):
+def insert(mpd, file, status):
     # https://mpd.readthedocs.io/en/latest/protocol.html#queuing
-    status = mpd.status()
     id = mpd.addid(file)
     if 'nextsongid' in status:
         nextsong = mpd.playlistid(status['nextsongid'])[0]
@@ -0,0 +1,107 @@
+from pathlib import Path
+
+import pytest
+
+import llm_mpd
+
+
+class FakeMPD:
+    """Just enough of MPDClient to queue a clip."""
+
+    def __init__(self, statuses, known=()):
+        self.statuses = list(statuses)
+        self.known = set(known)
+        self.calls = []
+
+    def __call__(self):
+        return self
+
+    def connect(self, mpd_socket):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def find(self, tag, file):
+        self.calls.append(('find', file))
+        return [{'file': file}] if file in self.known else []
+
+    def update(self, file):
+        self.calls.append(('update', file))
+        return '7'
+
+    def status(self):
+        if len(self.statuses) > 1:
+            return self.statuses.pop(0)
+        return self.statuses[0]
+
+    def idle(self, *subsystems):
+        self.calls.append(('idle',))
+        return list(subsystems)
+
+    def addid(self, file):
+        self.calls.append(('addid', file))
+        return '42'
+
+    def playlistid(self, songid):
+        return [{'id': songid, 'prio': '3'}]
+
+    def prioid(self, prio, songid):
+        self.calls.append(('prioid', prio, songid))
+
+
+@pytest.fixture
+def fake(monkeypatch):
+    def install(*args, **kwargs):
+        mpd = FakeMPD(*args, **kwargs)
+        monkeypatch.setattr(llm_mpd, 'MPDClient', mpd)
+        return mpd
+
+    return install
+
+
+def test_reused_clip_is_queued_without_update(fake):
+    mpd = fake([{'nextsongid': '5'}], known={'clips/a.opus'})
+
+    llm_mpd.present_clip('socket', Path('clips/a.opus'), '5', reused=True)
+
+    assert mpd.calls == [
+        ('find', 'clips/a.opus'),
+        ('addid', 'clips/a.opus'),
+        ('prioid', 4, '42'),
+    ]
+
+
+def test_reused_clip_is_queued_during_another_update(fake):
+    mpd = fake([{'nextsongid': '5', 'updating_db': '3'}],
+        known={'clips/a.opus'}
+    )
+
+    llm_mpd.present_clip('socket', Path('clips/a.opus'), '5', reused=True)
+
+    assert ('addid', 'clips/a.opus') in mpd.calls
+    assert ('idle',) not in mpd.calls
+
+
+def test_fresh_clip_is_queued_after_its_update(fake):
+    mpd = fake([
+        {'nextsongid': '5', 'updating_db': '7'},
+        {'nextsongid': '5'},
+    ])
+
+    llm_mpd.present_clip('socket', Path('clips/a.opus'), '5')
+
+    assert mpd.calls == [
+        ('update', 'clips/a.opus'),
+        ('idle',),
+        ('addid', 'clips/a.opus'),
+        ('prioid', 4, '42'),
+    ]
+
+
+def test_clip_is_dropped_when_next_song_changed(fake):
+    mpd = fake([{'nextsongid': '6'}])
+
+    llm_mpd.present_clip('socket', Path('clips/a.opus'), '5')
+
+    assert not any(call[0] == 'addid' for call in mpd.calls)
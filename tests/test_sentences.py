@@ -0,0 +1,31 @@
+from llm_mpd import sentences
+
+
+def test_ordinals_and_abbreviations_do_not_end_sentences():
+    chunks = ['Heute ist der 15. Oktober, und z. B. ', 'Nr. 1 der Charts folgt.']
+
+    assert list(sentences(chunks, min_length=0)) == [
+        'Heute ist der 15. Oktober, und z. B. Nr. 1 der Charts folgt.'
+    ]
+
+
+def test_short_sentences_are_joined():
+    chunks = ['Hallo Graz! ', 'Hier ist Nova. ', 'Jetzt kommt Musik. ']
+
+    assert list(sentences(chunks, min_length=20)) == [
+        'Hallo Graz! Hier ist Nova.', 'Jetzt kommt Musik.'
+    ]
+
+
+def test_sentences_are_yielded_while_streaming():
+    chunks = iter(['Das war ein langer Satz. ', 'Und noch'])
+
+    segments = sentences(chunks, min_length=10)
+
+    assert next(segments) == 'Das war ein langer Satz.'
+    assert next(chunks) == 'Und noch'
+
+
+def test_remaining_text_is_flushed():
+    assert list(sentences(['Ohne Punkt am Ende  '])) == ['Ohne Punkt am Ende']
+    assert list(sentences(['   '])) == []